@@ -36,10 +36,67 @@ Example :
     along with this program.  If not, see <https://www.gnu.org/licenses/>
 """
 
+import functools
+import keyword
 import logging as log
 import typing
 import colors
+import contextvars
 import re
+import string
+import weakref
+
+#: Regex matching a 'fg', 'bg' or 'style' property inside a color tag
+_CREGEX = re.compile(r'(fg|bg|style)=(\S+)')
+#: Regex matching a color or level tag and the string it bounds
+_SREGEX = re.compile(r'<(color|level)\s*([^>]*)>(.*?)</>', re.DOTALL)
+#: Current indent count, each thread or asynchronous task has its own
+_INDENT = contextvars.ContextVar('cilogger_indent', default=1)
+#: Default format of the root logger records
+_DEFAULT_FORMAT = ('<color fg=cyan>{asctime:12s}</> '
+                   '<level>{levelname: >8s}</> '
+                   '<color fg=green>{name: >35s}:</> '
+                   '<color fg=grey bg=#414141>{padding}</>'
+                   '<color fg=magenta>{realFunctionName}</>'
+                   '{prefix}<level>{message}</>')
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_color(scolor: str) -> tuple:
+    """ Parse the properties of a color tag. Results are cached as color tags are the same for each record
+
+    :param str scolor: The color string to inspect
+    :return: A tuple (<fg color>, <bg color>, <style>)
+    """
+    c = dict(_CREGEX.findall(scolor))
+    return c.get('fg'), c.get('bg'), c.get('style')
+
+
+@functools.lru_cache(maxsize=256)
+def _color_escapes(fg, bg, style) -> tuple:
+    """ Get the ANSI escape sequences that begin and end a colorized string. Results are cached to build them
+    only once per color
+
+    :param fg: Foreground color
+    :param bg: Background color
+    :param str style: Style names, separated by '+'
+    :return: A tuple (<prefix>, <suffix>)
+    """
+    prefix, _, suffix = colors.color('\x00', fg=fg, bg=bg, style=style).partition('\x00')
+    return prefix, suffix
+
+
+@functools.lru_cache(maxsize=256)
+def _padding(enclosure: str, char: str, align: str, width: int) -> str:
+    """ Get an indent padding string. Results are cached as the indent count only changes on indent and unindent
+
+    :param str enclosure: The padding enclosure
+    :param str char: The padding char
+    :param str align: The padding alignment, '>' or '<'
+    :param int width: The padding width
+    :return: The padding string
+    """
+    return '{:{}{}{}}'.format(enclosure, char, align, width)
 
 
 def finspect(f, fargs) -> dict:
@@ -74,7 +131,7 @@ def finspect(f, fargs) -> dict:
 
     if len(fargs) > 0:
         instance = fargs[0]
-        if isinstance(instance, object) and fname in dir(instance):
+        if hasattr(type(instance), fname):
             fmodule = '.'.join([instance.__class__.__module__, instance.__class__.__name__])
         else:
             fmodule = f.__module__
@@ -96,35 +153,64 @@ def ftrace(fct: typing.Callable) -> typing.Callable:
     """
     import inspect
 
+    # The signature of the function never changes, so its default args values are read only once
+    signature = inspect.signature(fct)
+    dargs = [v.default for v in signature.parameters.values() if v.default is not inspect.Parameter.empty]
+    # finspect results and the logger only depend on the function and on the class of its first argument.
+    # Classes are weakly referenced so that dynamically created classes can still be garbage collected
+    fi_cache = weakref.WeakKeyDictionary()
+    fi_noargs = None
+
+    @functools.wraps(fct)
     def ftraced(*args, **kwargs):
-        cargs = [a for a in args]
-        signature = inspect.signature(fct)
-        dargs = [v.default for k, v in signature.parameters.items() if v.default is not inspect.Parameter.empty]
-        fi = finspect(fct, args)
-        locallogger = ccilogger(fi['module'])
+        nonlocal fi_noargs
+        cached = fi_cache.get(type(args[0])) if args else fi_noargs
+        if cached is None:
+            fi = finspect(fct, args)
+            cached = (fi, ccilogger(fi['module']))
+            if args:
+                fi_cache[type(args[0])] = cached
+            else:
+                fi_noargs = cached
+        fi, locallogger = cached
+        if not locallogger.isEnabledFor(locallogger.TRACE):
+            # Traces are not logged, only keep the indentation of the other records
+            if fi['type'] is None:
+                locallogger.indent(locallogger.TRACE, '')
+                x = fct(*args, **kwargs)
+                locallogger.unindent(locallogger.TRACE, '')
+                return x
+            return fct(*args, **kwargs)
         if fi['type'] == 'setter':
-            aargs = cargs + dargs
-            locallogger.log(locallogger.TRACE, '( {} ) => set( {} )'.format(aargs[0], aargs[1]),
+            aargs = [*args, *dargs]
+            locallogger.log(locallogger.TRACE, '( %s ) => set( %s )', aargs[0], aargs[1],
                             extra={'realFunctionName': fi['name'], 'prefix': '',
                                    'padding_default_char': ' ',
                                    'padding_default_enclosure_char': '@'})
         elif fi['type'] is None:
-            locallogger.indent('TRACE', '( *{}, **{} )'.format(cargs + dargs, kwargs),
+            locallogger.indent('TRACE', '( *%s, **%s )', [*args, *dargs], kwargs,
                                extra={'realFunctionName': fi['name'], 'prefix': ''})
         x = fct(*args, **kwargs)
         if fi['type'] == 'getter':
-            aargs = cargs + dargs
-            locallogger.log(locallogger.TRACE, '( {} ) <= get( {} )'.format(aargs[0], x),
+            aargs = [*args, *dargs]
+            locallogger.log(locallogger.TRACE, '( %s ) <= get( %s )', aargs[0], x,
                             extra={'realFunctionName': fi['name'], 'prefix': '',
                                    'padding_default_char': ' ',
                                    'padding_default_enclosure_char': '#'})
         elif fi['type'] is None:
-            locallogger.unindent('TRACE', '( *{}, **{} ) = {}'.format(cargs + dargs, kwargs, x),
+            locallogger.unindent('TRACE', '( *%s, **%s ) = %s', [*args, *dargs], kwargs, x,
                                  extra={'realFunctionName': fi['name'], 'prefix': ''})
         return x
+
+    # Mark the wrapper so that ctrace doesn't trace it twice
+    ftraced._ftraced = True
     return ftraced
 
 
+#: Property accessor names that are never traced by ctrace
+_PROP_SKIP = frozenset(('log', '_log', '__log__', '_internal_'))
+
+
 def ctrace(cls: object):
     """Decorator for tracing all methods and properties in a class
     This decorator add a ftrace decorator on each method and property o the class
@@ -133,24 +219,107 @@ def ctrace(cls: object):
     :return: A class with all methods and properties wrapped by a ftrace decorator
     """
     import types
-    for method in dir(cls):
-        m = getattr(cls, method)
-        if isinstance(m, types.FunctionType) and m.__name__ == '__init__':
-            setattr(cls, method, ftrace(m))
-        if isinstance(m, types.FunctionType) \
-                and not m.__name__ == 'ftraced' \
-                and not m.__name__.startswith('__') \
-                and not m.__name__.startswith('_internal_') \
-                and not m.__name__.endswith('__'):
-            setattr(cls, method, ftrace(m))
-        if isinstance(m, property) and \
-                ((m.fget is not None and m.fget.__name__ not in ['log', '_log', '__log__', 'ftraced', '_internal_']) or
-                 (m.fset is not None and m.fset.__name__ not in ['log', '_log', '__log__', 'ftraced', '_internal_']) or
-                 (m.fdel is not None and m.fdel.__name__ not in ['log', '_log', '__log__', 'ftraced', '_internal_'])):
-            setattr(cls, method, property(ftrace(m.__get__), ftrace(m.__set__), ftrace(m.__delattr__)))
+    # Only the attributes defined in the class itself are traced, not the inherited ones
+    for method, m in list(vars(cls).items()):
+        if isinstance(m, types.FunctionType):
+            name = m.__name__
+            if getattr(m, '_ftraced', False):
+                # Already traced
+                continue
+            if name == '__init__' or not (name.startswith('__') or name.endswith('__') or
+                                          name.startswith('_internal_')):
+                setattr(cls, method, ftrace(m))
+        elif isinstance(m, property):
+            if any(f is not None and not getattr(f, '_ftraced', False) and f.__name__ not in _PROP_SKIP
+                   for f in (m.fget, m.fset, m.fdel)):
+                setattr(cls, method, property(ftrace(m.__get__), ftrace(m.__set__), ftrace(m.__delattr__)))
     return cls
 
 
+def _level_escapes(record: object) -> tuple:
+    """ Get the ANSI escape sequences of a record level color
+
+    :param object record: A record object containing level's colors
+    :return: A tuple (<prefix>, <suffix>)
+    """
+    c = record.clevel.get(record.levelname)
+    if c is None:
+        return '', ''
+    return _color_escapes(c['fg'], c['bg'], c['style'])
+
+
+def _compile_format(fmt: str) -> typing.Optional[typing.Callable]:
+    """ Compile a '{' style format string with color and level tags into a function formatting a record. Static
+    colors are resolved at compile time and level colors with a dict lookup, so no tag is parsed when formatting
+    a record
+
+    :param str fmt: The format string
+    :return: A function taking a record and returning the colorized message, or None if the format uses
+             features that are not compiled (nested or unbalanced tags, complex fields, invalid colors)
+    """
+    # Split the format string in texts with record fields, static escapes and level escapes
+    parts = []
+    pos = 0
+    for m in _SREGEX.finditer(fmt):
+        parts.append(('text', fmt[pos:m.start()]))
+        if m.group(1) == 'level':
+            parts.extend((('level', '_lprefix'), ('text', m.group(3)), ('level', '_lsuffix')))
+        else:
+            try:
+                prefix, suffix = _color_escapes(*_parse_color(m.group(2)))
+            except ValueError:
+                return None
+            parts.extend((('escape', prefix), ('text', m.group(3)), ('escape', suffix)))
+        pos = m.end()
+    parts.append(('text', fmt[pos:]))
+
+    # Build the body of an f-string, static strings are read from the namespace of the generated function
+    namespace = {'_level_escapes': _level_escapes}
+    fstring = []
+    static = []
+
+    def flush_static():
+        if static:
+            name = '_s{}'.format(len(namespace))
+            namespace[name] = ''.join(static)
+            fstring.append('{' + name + '}')
+            static.clear()
+
+    for kind, value in parts:
+        if kind == 'escape':
+            static.append(value)
+        elif kind == 'level':
+            flush_static()
+            fstring.append('{' + value + '}')
+        else:
+            if '<color' in value or '<level' in value or '</>' in value:
+                return None
+            try:
+                fields = list(string.Formatter().parse(value))
+            except ValueError:
+                return None
+            for literal, field, spec, conversion in fields:
+                static.append(literal)
+                if field is None:
+                    continue
+                if not field.isidentifier() or keyword.iskeyword(field) or any(c in spec for c in '{}\\\'\n'):
+                    return None
+                flush_static()
+                fstring.append('{record.' + field + ('!' + conversion if conversion else '') +
+                               (':' + spec if spec else '') + '}')
+    flush_static()
+
+    src = 'def _format(record):\n'
+    if any(kind == 'level' for kind, _ in parts):
+        src += '    _lprefix, _lsuffix = _level_escapes(record)\n'
+    src += "    return f'" + ''.join(fstring) + "'\n"
+    try:
+        exec(compile(src, '<cilogger format>', 'exec'), namespace)
+    except SyntaxError:
+        return None
+    return namespace['_format']
+
+
 class CiFormatter(log.Formatter):
     """Custom logging Formatter for colorizing all record that are bounded with a color or level tag:
 
@@ -163,49 +332,61 @@ class CiFormatter(log.Formatter):
     def __init__(self, fmt=None, datefmt=None, style='%',custom_lvl_formaters={}):
         super().__init__(fmt, datefmt, style)
         self.custom_lvl_formaters=custom_lvl_formaters
-
-    def _get_color(self: object, scolor: str, c: dict):
-        """This function inspect recursively the string searching 'fg', 'bg' and 'style' tags
-        and assign the founded color to the color dict
-
-        :param str scolor: The color string to inspect
-        :param dict c: The color dict {'fg': <fg color>, 'bg': <bg color>, 'style': <style>}
-        :return: The color dict with founded colors
-        """
-        cregex = re.compile(r'(fg|bg|style)=(\S+)')
-        m = cregex.search(scolor)
-        if m:
-            tag = m.group(1)
-            ctag = m.group(2)
-            c[tag] = ctag
-            return self._get_color(cregex.sub('', scolor, 1), c)
-        else:
-            return c
+        self._str_style = isinstance(self._style, log.StrFormatStyle)
+        #: Compiled format functions by format string, None when a format can't be compiled
+        self._compiled_formats = {}
 
     def _colorize(self, s: str, record: object):
         """ Colorize a string with a static color or a level dependent color. Colors are set in the format logger
-        string and parsed recursively by this function
+        string and all tags are replaced in a single pass. Another pass is only done when replacing a tag has
+        revealed a new one
 
         :param str s: A string containing the message to colorize.
         :param object record: A record object containing level's colors
         :return: A colorized string
         """
-        sregex = re.compile(r'<(color|level)\s*([^>]*)>(.*?)</>', re.DOTALL)
-        m = sregex.search(s)
-        if m:
+        if '</>' not in s:
+            # No tag to colorize, skip the regex engine
+            return s
+
+        def wcolor(m):
             tag = m.group(1)
             scolor = m.group(2)
             w = m.group(3)
-            c = {'fg': None, 'bg': None, 'style': None}
             if tag == 'level':
-                if record.levelname in record.clevel:
-                    c = record.clevel[record.levelname]
+                c = record.clevel.get(record.levelname)
+                if c is None:
+                    return w
+                prefix, suffix = _color_escapes(c['fg'], c['bg'], c['style'])
             else:
-                c = self._get_color(scolor, c)
-            wcolor = colors.color(w, fg=c['fg'], bg=c['bg'], style=c['style'])
-            return self._colorize(sregex.sub(wcolor, s, 1), record)
-        else:
-            return s
+                prefix, suffix = _color_escapes(*_parse_color(scolor))
+            return prefix + w + suffix
+
+        # Each pass removes at least one closing tag, so this loop always ends. Another pass is only needed
+        # when closing tags are left
+        s, n = _SREGEX.subn(wcolor, s)
+        while n and '</>' in s:
+            s, n = _SREGEX.subn(wcolor, s)
+        return s
+
+    def formatMessage(self, record: object):
+        """ The logging Formatter formatMessage function. '{' style formats are compiled on first use into a
+        function that formats and colorizes the record without parsing the format string for each record.
+        Record fields are inserted inside the already colorized format tags, so a closing tag in a field value,
+        like a message, doesn't end the color of the format tag anymore
+
+        :param object record: Logging's record
+        :return: The formatted message
+        """
+        fmt = self._style._fmt
+        try:
+            compiled_format = self._compiled_formats[fmt]
+        except KeyError:
+            compiled_format = _compile_format(fmt) if self._str_style else None
+            self._compiled_formats[fmt] = compiled_format
+        if compiled_format is not None:
+            return compiled_format(record)
+        return super().formatMessage(record)
 
     def format(self, record: object):
         """ The logging Formatter format function and after we apply our colorize method
@@ -226,13 +407,32 @@ class CiFormatter(log.Formatter):
         return s
 
 
+#: Int levels of the string levels accepted by CiLogger
+_LVL = {'NOTSET': log.NOTSET,
+        'TRACE': 5,
+        'DEBUG': log.DEBUG,
+        'INFO': log.INFO,
+        'WARNING': log.WARNING,
+        'ERROR': log.ERROR,
+        'FATAL': log.FATAL,
+        'CRITICAL': log.CRITICAL}
+log.addLevelName(_LVL['TRACE'], 'TRACE')
+
+
 class CiLogger(log.getLoggerClass()):
     """ This class provides an extension to the logging module and adds logs indentation and colorization
 
     """
 
-    #: Current indent count
-    indent_count = 1
+    #: Log levels
+    NOTSET = _LVL['NOTSET']
+    TRACE = _LVL['TRACE']
+    DEBUG = _LVL['DEBUG']
+    INFO = _LVL['INFO']
+    WARNING = _LVL['WARNING']
+    ERROR = _LVL['ERROR']
+    FATAL = _LVL['FATAL']
+    CRITICAL = _LVL['CRITICAL']
     #: Indent step
     indent_step = 1
     #: Indent padding enclosure when not starting or ending an indent block
@@ -280,50 +480,45 @@ class CiLogger(log.getLoggerClass()):
 
     def __init__(self: object, name: str, level: int = log.NOTSET):
         super().__init__(name=name, level=level)
-        self.NOTSET = log.NOTSET
-        self.TRACE = 5
-        self.DEBUG = log.DEBUG
-        self.INFO = log.INFO
-        self.WARNING = log.WARNING
-        self.ERROR = log.ERROR
-        self.FATAL = log.FATAL
-        self.CRITICAL = log.CRITICAL
-        log.addLevelName(self.TRACE, 'TRACE')
         self.addFilter(self._internal_filter)
 
+    @property
+    def indent_count(self: object) -> int:
+        """ Current indent count of the running thread or asynchronous task. It can be set on a logger instance
+        to change the indent count of the running thread or asynchronous task, but not on the CiLogger class
+
+        :return: The indent count
+        """
+        return _INDENT.get()
+
+    @indent_count.setter
+    def indent_count(self: object, value: int):
+        _INDENT.set(value)
+
     def _lvl2int(self: object, lvl: str) -> int:
         """ Convert a string level to int level
 
         :param str lvl: A string level
         :return: Int level
         """
-        if isinstance(lvl, str):
-            return getattr(self, lvl)
+        if type(lvl) is int:
+            return lvl
+        elif isinstance(lvl, str):
+            try:
+                return _LVL[lvl]
+            except KeyError:
+                # Level defined by a CiLogger subclass
+                return getattr(type(self), lvl)
         else:
             return int(lvl)
 
-    @staticmethod
-    def _update_extra(kwargs: dict, attribut: str, value: any):
-        """ Update extra dict in kwargs if exists with {attribut: value}
-
-        :param dict kwargs: A kwargs dict
-        :param str attribut:
-        :param any value:
-        :return: A kwargs dict updated with {attribut: value}
-        """
-        if 'extra' in kwargs:
-            kwargs['extra'].update({attribut: value})
-        else:
-            kwargs.update({'extra': {attribut: value}})
-        return kwargs
-
     def indent(self: object, level: typing.Union[int, str], msg: str, *args, **kwargs):
         """Logs a message and starts a new indent block. The arguments are interpreted as for the
         `log() <https://docs.python.org/3/library/logging.html#logging.Logger.log>`_ function from the
         `logging module <https://docs.python.org/3/library/logging.html>`_
         """
-        type(self).indent_count += self.indent_step
-        self._update_extra(kwargs, 'indent', 'start')
+        _INDENT.set(_INDENT.get() + self.indent_step)
+        kwargs.setdefault('extra', {})['indent'] = 'start'
         intlevel = self._lvl2int(level)
         if self.isEnabledFor(intlevel):
             self._log(intlevel, msg, args, **kwargs)
@@ -333,11 +528,11 @@ class CiLogger(log.getLoggerClass()):
         `log() <https://docs.python.org/3/library/logging.html#logging.Logger.log>`_ function from the
         `logging module <https://docs.python.org/3/library/logging.html>`_
         """
-        self._update_extra(kwargs, 'indent', 'end')
+        kwargs.setdefault('extra', {})['indent'] = 'end'
         intlevel = self._lvl2int(level)
         if self.isEnabledFor(intlevel):
             self._log(intlevel, msg, args, **kwargs)
-        type(self).indent_count -= self.indent_step
+        _INDENT.set(_INDENT.get() - self.indent_step)
 
     def trace(self: object, msg: str, *args, **kwargs):
         """ Logs a message with level TRACE on this logger. The arguments are interpreted as for the
@@ -353,28 +548,31 @@ class CiLogger(log.getLoggerClass()):
         :param record: A logging recod object
         :return: True
         """
-        record.clevel = self.levelcolors
-
-        if not hasattr(record, 'indent'):
-            record.indent = 'default'
-        if not hasattr(record, 'padding_default_char'):
-            record.padding_default_char = self.padding_default_char
-        if not hasattr(record, 'padding_default_enclosure_char'):
-            record.padding_default_enclosure_char = self.padding_default_enclosure_char
-        if not hasattr(record, 'prefix'):
-            record.prefix = self.message_default_prefix
-        if not hasattr(record, 'realFunctionName'):
-            record.realFunctionName = record.funcName
-
-        record.padding = '{:{}>{}}'.format(record.padding_default_enclosure_char,
-                                           record.padding_default_char, self.indent_count)
-
+        d = record.__dict__
+        if type(record) is not log.LogRecord:
+            # Defaults defined as class attributes of a custom record class take precedence over the logger ones
+            for attribut in ('indent', 'padding_default_char', 'padding_default_enclosure_char', 'prefix',
+                             'realFunctionName'):
+                if attribut not in d and hasattr(record, attribut):
+                    d[attribut] = getattr(record, attribut)
+        d.setdefault('indent', 'default')
+        d.setdefault('padding_default_char', self.padding_default_char)
+        d.setdefault('padding_default_enclosure_char', self.padding_default_enclosure_char)
+        d.setdefault('prefix', self.message_default_prefix)
+        if 'realFunctionName' not in d:
+            d['realFunctionName'] = record.funcName
+        d['clevel'] = self.levelcolors
+
+        indent_count = _INDENT.get()
         if record.indent == 'start':
-            record.padding = '{:{}>{}}'.format(self.padding_start_enclosure_char,
-                                               self.padding_start_char, self.indent_count)
+            record.padding = _padding(self.padding_start_enclosure_char,
+                                      self.padding_start_char, '>', indent_count)
         elif record.indent == 'end':
-            record.padding = '{:{}<{}}'.format(self.padding_end_enclosure_char,
-                                               self.padding_end_char, self.indent_count)
+            record.padding = _padding(self.padding_end_enclosure_char,
+                                      self.padding_end_char, '<', indent_count)
+        else:
+            record.padding = _padding(record.padding_default_enclosure_char,
+                                      record.padding_default_char, '>', indent_count)
 
         return True
 
@@ -389,13 +587,7 @@ def _rcilogger(custom_lvl_formaters={}):
     """
     log.setLoggerClass(CiLogger)
     handler = log.StreamHandler()
-    ciformatter = CiFormatter('<color fg=cyan>{asctime:12s}</> '
-                              '<level>{levelname: >8s}</> '
-                              '<color fg=green>{name: >35s}:</> '
-                              '<color fg=grey bg=#414141>{padding}</>'
-                              '<color fg=magenta>{realFunctionName}</>'
-                              '{prefix}<level>{message}</>',
-                              style='{', custom_lvl_formaters=custom_lvl_formaters)
+    ciformatter = CiFormatter(_DEFAULT_FORMAT, style='{', custom_lvl_formaters=custom_lvl_formaters)
     handler.setFormatter(ciformatter)
     rlogger = log.getLogger('root')
     for hdlr in rlogger.handlers: